@@ -6,7 +6,11 @@
 
 import json
 import logging
-from datetime import datetime
+import queue
+import time
+from datetime import datetime, timezone
+from functools import lru_cache
+from math import isfinite
 from pathlib import Path
 from uuid import uuid4
 
@@ -16,9 +20,31 @@ LOG = logging.getLogger(__name__)
 try:
     from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
 except ImportError:
-    LOG.exception(
-        "AWSIoTPythonSDK not available. Run pip install AWSIoTPythonSDK in the ATGMLogger environment.")
-    raise
+    AWSIoTMQTTClient = None
+
+try:
+    import paho.mqtt.client as paho_mqtt
+except ImportError:
+    paho_mqtt = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    _json_dumps = orjson.dumps
+    # Values orjson cannot encode, e.g. integers wider than 64 bits
+    _ENCODE_ERRORS = (orjson.JSONEncodeError,)
+else:
+    def _json_dumps(obj):
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+    _ENCODE_ERRORS = ()
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 """
 MQTTClient Plugin (mqtt)
@@ -33,18 +59,34 @@ authenticating with a X509 certificate/private-key.
 Dependencies
 ------------
 AWSIoTPythonSDK (available from PyPi via pip)
+    Required for the default awsiot transport.
 
     >>> pip install AWSIoTPythonSDK
 
+paho-mqtt (optional, available from PyPi via pip)
+    Required only if the paho transport is selected.
+
+    >>> pip install paho-mqtt
+
+orjson (optional, available from PyPi via pip)
+    Faster JSON encoding of published payloads, falls back to the standard
+    library json module if not installed. Note that orjson encodes NaN and
+    Infinity values as null, where the json module writes NaN/Infinity, and
+    that orjson rejects integers wider than 64 bits (such lines are skipped).
+
+    >>> pip install orjson
+
+msgpack (optional, available from PyPi via pip)
+    Required only if the msgpack payload encoding is selected.
+
+    >>> pip install msgpack
+
 Notes
 -----
 Full line of data is approx 124 bytes, or approx 160 bytes when wrapped with 
-JSON and device metadata
-
-TODO
-----
-Option to batch send data as Json list of maps (reduce IoT cost if each 
-message is < 5kb)
+JSON and device metadata. AWS IoT bills messages in 5kb increments, so
+batching several lines into a single message (see the batch option) can
+considerably reduce IoT cost.
 
 
 MQTT Plugin configuration options:
@@ -69,13 +111,37 @@ devcert : String
 interval : Number, optional
     Optional interval of ticks at which to send a data line, e.g. with default 1, every data line is sent,
     with interval of 10, every 10th data line is sent.
+batch : Number, optional
+    Optional number of data lines to collect before publishing them as a
+    single message, default 1 (no batching). Batched messages are published as
+    {'d': sensorid, 'b': [{'t': timestamp, 'v': {...}}, ...]}, and are sent
+    early if the message size approaches the 5kb AWS IoT billing increment.
+    Any pending batch is sent when the plugin exits.
+encoding : String, optional
+    Payload encoding, either 'json' (default) or 'msgpack'. MessagePack
+    payloads are published to the topic with a '/mp' suffix appended, and
+    must be decoded by subscribers with msgpack.unpackb
+compact : Boolean, optional
+    Optional, if true messages are published as a flat array
+    [sensorid, timestamp, value, ...] instead of a map, omitting the field
+    names from every message (batched records become [timestamp, value, ...]).
+    The field order is published once on connection to the '<topic>/schema'
+    topic as {'d': sensorid, 'fields': ['t', field, ...]}. Default false.
+transport : String, optional
+    MQTT client used to connect to AWS IoT, either 'awsiot' (default) to use
+    the AWSIoTPythonSDK client, or 'paho' to use paho-mqtt directly. The paho
+    client has no offline publish queue, but avoids the SDK's queueing and
+    locking overhead on every publish.
 
 """
 
 
+_CFG_DIR = Path('/etc/atgmlogger')
+
+
 def join_cfg(path):
     """Append the application base config directory to given path."""
-    return str(Path('/etc/atgmlogger').joinpath(path))
+    return str(_CFG_DIR / path)
 
 
 def convert_gps_time(gpsweek, gpsweekseconds):
@@ -123,26 +189,46 @@ $UW,-9696,-7781,4628,4118252,257,409,199,32888,128,73,-42,4362,4139315,39.909203
 """
 
 
+@lru_cache(maxsize=512)
+def _parse_time(meter_time):
+    # Fixed width YYYYMMDDHHmmss, sliced directly instead of using strptime
+    if len(meter_time) != 14 or not meter_time.isdigit():
+        raise ValueError("Invalid meter time: %s" % meter_time)
+    return datetime(int(meter_time[0:4]), int(meter_time[4:6]),
+                    int(meter_time[6:8]), int(meter_time[8:10]),
+                    int(meter_time[10:12]), int(meter_time[12:14]),
+                    tzinfo=timezone.utc).timestamp()
+
+
 def convert_time(meter_time):
-    fmt = '%Y%m%d%H%M%S'
+    """Convert a meter timestamp (YYYYMMDDHHmmss, UTC) to a UNIX timestamp,
+    falling back to the current time if the timestamp is invalid.
+
+    Successful parses are cached, as consecutive lines often share the same
+    (second resolution) timestamp.
+    """
     try:
-        return datetime.strptime(meter_time, fmt).timestamp()
+        return _parse_time(meter_time)
     except ValueError:
-        return datetime.utcnow().timestamp()
+        return time.time()
 
 
 class MQTTClient(PluginInterface):
     options = ['sensorid', 'topicid', 'topic_pfx', 'endpoint', 'rootca',
                'prikey', 'devcert', 'batch', 'interval',
-               'fields', 'datafmt']
+               'fields', 'datafmt', 'encoding', 'compact', 'transport']
     topic_pfx = 'gravity'
     endpoint = None
     rootca = 'root-CA.crt'
     prikey = 'iot.private.key'
     devcert = 'iot.cert.pem'
     interval = 1
+    batch = 1
     fields = ['gravity', 'long', 'cross', 'latitude', 'longitude', 'datetime']
     datafmt = 'marine'
+    encoding = 'json'
+    compact = False
+    transport = 'awsiot'
 
     # Ordered list of marine fields
     _marine_fieldmap = ['header', 'gravity', 'long', 'cross', 'beam', 'temp',
@@ -151,6 +237,12 @@ class MQTTClient(PluginInterface):
                         'speed', 'course', 'datetime']
     _airborne_fieldmap = []
 
+    # Publish a batch early once its encoded size approaches 5kb
+    _batch_max_bytes = 4500
+
+    # MQTT keep-alive interval (seconds) for the AWS IoT connection
+    _keepalive = 30
+
     # Defaults to integer cast if not specified here
     _field_casts = {
         'header': str,
@@ -162,6 +254,12 @@ class MQTTClient(PluginInterface):
         'datetime': convert_time
     }
 
+    # Lower-cased field names and their casts, in marine fieldmap order
+    _marine_fieldmap_lower = [f.lower() for f in _marine_fieldmap]
+    # map(), as a class-body comprehension cannot see _field_casts
+    _field_casts_by_idx = list(map(_field_casts.get, _marine_fieldmap_lower,
+                                   [int] * len(_marine_fieldmap_lower)))
+
     def __init__(self):
         super().__init__()
         # Set AWSIoTPythonSDK logger level from default
@@ -169,88 +267,308 @@ class MQTTClient(PluginInterface):
         self.client = None
         self.tick = 0
         self.sensorid = None
+        self._encode = _json_dumps
+        self._topic = None
+        self._rootca = None
+        self._prikey = None
+        self._devcert = None
+        self._schema = []
+        self._max_idx = 0
+        self._template = None
+        self._batch = []
+        self._record_bytes = 0
         self._errcount = 0
 
-    @classmethod
-    def extract_fields(cls, data: str, fieldmap=_marine_fieldmap):
+    def _compile_schema(self):
+        """Build the (index, field, cast) table for the configured fields, so
+        that field selection and cast lookup are not repeated per line."""
+        self.fields = frozenset(str(f).lower() for f in self.fields)
+        self._schema = [(i, field, cast) for i, (field, cast) in
+                        enumerate(zip(self._marine_fieldmap_lower,
+                                      self._field_casts_by_idx))
+                        if field in self.fields]
+        if not self._schema:
+            raise ValueError("No valid fields configured for MQTT Plugin: %s"
+                             % sorted(self.fields))
+        # Lines need only be split up to the last configured field
+        self._max_idx = max(i for i, _, _ in self._schema)
+
+    def extract_fields(self, parts: list):
         extracted = {}
-        data = data.split(',')
-        for i, field in enumerate(fieldmap):
-            if field.lower() in cls.fields:
-                try:
-                    extracted[field] = cls._field_casts.get(field.lower(), int)(
-                        data[i])
-                except ValueError:
-                    extracted[field] = data[i]
+        for i, field, cast in self._schema:
+            try:
+                extracted[field] = cast(parts[i])
+            except ValueError:
+                extracted[field] = parts[i]
         return extracted
 
+    def extract_values(self, parts: list):
+        """Extract the configured fields as a list of values, ordered as in the
+        compiled schema, for the compact message layout."""
+        extracted = []
+        for i, field, cast in self._schema:
+            try:
+                extracted.append(cast(parts[i]))
+            except ValueError:
+                extracted.append(parts[i])
+        return extracted
+
+    def _compile_template(self):
+        """Build a bytes format template for single JSON messages where every
+        configured field is numeric, or return None if not applicable.
+
+        The template is only used if orjson is not available: it is ~2.5x
+        faster than the standard library json encoder, but slower than orjson.
+        Lines with a non-finite (nan/inf) value bypass the template and are
+        encoded by the json module, which writes NaN/Infinity; such messages
+        are not strict JSON.
+        """
+        numeric = (int, float, convert_time)
+        if (orjson is not None or self.encoding != 'json' or self.batch > 1 or
+                not all(cast in numeric for _, _, cast in self._schema)):
+            return None
+        sensorid = json.dumps(self.sensorid).encode('utf-8').replace(b'%',
+                                                                     b'%%')
+        if self.compact:
+            return (b'[' + sensorid + b',%a' +
+                    b''.join(b',%a' for _ in self._schema) + b']')
+        values = b','.join(b'"' + field.encode('utf-8') + b'":%a'
+                           for _, field, _ in self._schema)
+        return b'{"d":' + sensorid + b',"t":%a,"v":{' + values + b'}}'
+
+    def _format_template(self, parts: list, timestamp):
+        """Format a line's values into the compiled template, or return None
+        if a value is non-numeric or non-finite (repr of nan/inf is not JSON)
+        so that the generic encoder is used instead."""
+        try:
+            values = [cast(parts[i]) for i, _, cast in self._schema]
+        except ValueError:
+            return None
+        for value in values:
+            if value.__class__ is float and not isfinite(value):
+                return None
+        return self._template % (timestamp, *values)
+
     @staticmethod
     def consumer_type() -> set:
         return {str}
 
-    # def _batch_process(self):
-    #     # TODO: Implement batch publish feature, perhaps collect items in a queue until a limit is reached
-    #     # then publish as a list of json maps
-    #     sendqueue = []
-    #     limit = 10
+    def _batch_publish(self, record):
+        """Add a record to the pending batch, publishing the batch once it is
+        full or nearing the 5kb message size limit."""
+        if not self._batch:
+            # Size estimate for the batch, based on its first record only
+            self._record_bytes = len(self._encode(record))
+        self._batch.append(record)
+        if (len(self._batch) >= self.batch or
+                len(self._batch) * self._record_bytes > self._batch_max_bytes):
+            self._flush_batch()
+
+    def _flush_batch(self):
+        if not self._batch:
+            return
+        # Take the pending records first, so a batch that fails to encode or
+        # publish is dropped rather than retried on every following record
+        batch, self._batch = self._batch, []
+        try:
+            payload = self._encode({'d': self.sensorid, 'b': batch})
+        except _ENCODE_ERRORS as e:
+            LOG.warning("Unable to encode MQTT batch, %d records dropped: %s",
+                        len(batch), e)
+            return
+        try:
+            self.client.publish(self._topic, payload, 0)
+        except Exception:
+            LOG.error("Failed to publish MQTT batch, %d records dropped.",
+                      len(batch))
+            raise
 
     def configure_client(self):
         if self.endpoint is None:
             raise ValueError("No endpoint provided for MQTT Plugin.")
+        if self.encoding == 'msgpack':
+            if msgpack is None:
+                raise ImportError("msgpack encoding requested but msgpack is "
+                                  "not available. Run pip install msgpack in "
+                                  "the ATGMLogger environment.")
+            # A single Packer reuses its internal buffer across messages,
+            # where packb() allocates a new Packer and buffer on every call
+            self._encode = msgpack.Packer().pack
+        elif self.encoding != 'json':
+            raise ValueError("Invalid encoding for MQTT Plugin: %s"
+                             % self.encoding)
+        if self.transport == 'awsiot':
+            if AWSIoTMQTTClient is None:
+                raise ImportError("AWSIoTPythonSDK not available. Run pip "
+                                  "install AWSIoTPythonSDK in the ATGMLogger "
+                                  "environment.")
+        elif self.transport == 'paho':
+            if paho_mqtt is None:
+                raise ImportError("paho transport requested but paho-mqtt is "
+                                  "not available. Run pip install paho-mqtt "
+                                  "in the ATGMLogger environment.")
+        else:
+            raise ValueError("Invalid transport for MQTT Plugin: %s"
+                             % self.transport)
+        self.interval = int(self.interval)
+        self.batch = int(self.batch)
+        if self.interval < 1 or self.batch < 1:
+            raise ValueError("MQTT Plugin interval and batch must be >= 1.")
+        self._compile_schema()
         try:
-            self.sensorid = getattr(self, 'sensorid', str(uuid4())[0:8])
+            if not self.sensorid:
+                self.sensorid = str(uuid4())[0:8]
             topicid = getattr(self, 'topicid', self.sensorid)
 
-            self.client = AWSIoTMQTTClient(self.sensorid, useWebsocket=False)
-            self.client.configureEndpoint(self.endpoint, 8883)
-            self.client.configureOfflinePublishQueueing(10000)
-            self.client.configureConnectDisconnectTimeout(10)
-            self.client.configureCredentials(join_cfg(self.rootca),
-                                             join_cfg(self.prikey),
-                                             join_cfg(self.devcert))
-            self.client.configureDrainingFrequency(2)
-            self.client.configureMQTTOperationTimeout(5)
-            self.client.connect()
+            self._rootca = join_cfg(self.rootca)
+            self._prikey = join_cfg(self.prikey)
+            self._devcert = join_cfg(self.devcert)
+
+            if self.transport == 'paho':
+                self.client = self._connect_paho()
+            else:
+                self.client = self._connect_awsiot()
 
             topic = '/'.join([self.topic_pfx, topicid])
+            if self.encoding == 'msgpack':
+                topic += '/mp'
+            self._topic = topic
+            self._template = self._compile_template()
+
+            if self.compact:
+                # Publish the field order of compact messages for subscribers
+                schema = {'d': self.sensorid,
+                          'fields': ['t'] + [f for _, f, _ in self._schema]}
+                self.client.publish(topic + '/schema', self._encode(schema), 1)
         except AttributeError:
             LOG.exception(
                 "Missing attributes from configuration for MQTT plugin.")
             raise
-        return topic
+
+    def _connect_awsiot(self):
+        client = AWSIoTMQTTClient(self.sensorid, useWebsocket=False)
+        client.configureEndpoint(self.endpoint, 8883)
+        client.configureOfflinePublishQueueing(10000)
+        client.configureConnectDisconnectTimeout(5)
+        client.configureCredentials(self._rootca, self._prikey, self._devcert)
+        # Drain messages queued while offline quickly once reconnected
+        client.configureDrainingFrequency(50)
+        client.configureMQTTOperationTimeout(5)
+        # Ping well within the SDK default of 600s, so idle connections are
+        # kept open and dropped links are detected (and reconnected) sooner
+        client.connect(keepAliveIntervalSecond=self._keepalive)
+        return client
+
+    def _connect_paho(self):
+        kwargs = {'client_id': self.sensorid}
+        if hasattr(paho_mqtt, 'CallbackAPIVersion'):
+            # paho-mqtt >= 2.0 requires an explicit callback API version
+            version = paho_mqtt.CallbackAPIVersion.VERSION2
+            kwargs['callback_api_version'] = version
+        client = paho_mqtt.Client(**kwargs)
+        client.tls_set(ca_certs=self._rootca, certfile=self._devcert,
+                       keyfile=self._prikey)
+        client.connect(self.endpoint, 8883)
+        # Network loop runs (and reconnects) in a background thread
+        client.loop_start()
+        return client
+
+    def _drain(self):
+        """Block until an item is available, then collect any further items
+        already waiting in the queue without blocking."""
+        items = [self.get(block=True, timeout=None)]
+        while True:
+            try:
+                items.append(self.get(block=False))
+            except queue.Empty:
+                return items
 
     def run(self):
-        topic = self.configure_client()
+        self.configure_client()
+
+        # Bind attributes used per line to locals for the loop below
+        drain = self._drain
+        task_done = self.task_done
+        publish = self.client.publish
+        batch_publish = self._batch_publish
+        encode = self._encode
+        topic = self._topic
+        sensorid = self.sensorid
+        interval = self.interval
+        batched = self.batch > 1
+        compact = self.compact
+        extract = self.extract_values if compact else self.extract_fields
+        maxsplit = self._max_idx + 1
+        template = self._template
+        format_template = self._format_template
+        tick = self.tick
+
         while not self.exiting:
-            item = self.get(block=True, timeout=None)
-            self.tick += 1
-            if item is None or item == "" or self.tick % self.interval:
-                self.task_done()
-                continue
-            else:
-                try:
-                    self.tick = 0  # reset tick count
-                    fields = item.split(',')
-                    timestamp = convert_time(fields[-1])
-                    if not len(fields):
+            items = drain()
+            try:
+                for item in items:
+                    if not item:
+                        # Null/empty items don't count towards the interval
+                        continue
+                    tick += 1
+                    if tick % interval:
+                        # Dropped tick, skip before any parsing is done
+                        continue
+                    tick = 0  # reset tick count
+                    payload = None
+                    try:
+                        parts = item.split(',', maxsplit)
+                        # Meter time is the last column of the line
+                        timestamp = convert_time(item.rpartition(',')[2])
+                        if template is not None:
+                            payload = format_template(parts, timestamp)
+                        if payload is None:
+                            if compact:
+                                record = [timestamp, *extract(parts)]
+                            else:
+                                record = {'t': timestamp, 'v': extract(parts)}
+                    except (ValueError, IndexError, KeyError) as e:
+                        LOG.warning("Invalid data line, skipping: %s: %s",
+                                    e.__class__.__name__, item)
                         continue
 
-                    data_dict = self.extract_fields(item)
-
-                    item_json = json.dumps(
-                        {'d': self.sensorid, 't': timestamp, 'v': data_dict})
-                    self.client.publish(topic, item_json, 0)
-                    self.task_done()
-                except:
-                    LOG.exception(
-                        "Exception occured in mqtt-run loop. Item value: %s",
-                        item)
-                    self._errcount += 1
-                    if self._errcount > 10:
-                        # Terminate MQTT if errors accumulate
-                        raise
-
+                    try:
+                        if batched:
+                            batch_publish(record)
+                        elif payload is not None:
+                            publish(topic, payload, 0)
+                        elif compact:
+                            publish(topic, encode([sensorid, *record]), 0)
+                        else:
+                            publish(topic,
+                                    encode({'d': sensorid, **record}), 0)
+                    except _ENCODE_ERRORS as e:
+                        LOG.warning("Unable to encode data line, skipping: "
+                                    "%s: %s", e, item)
+                    except Exception:
+                        LOG.exception(
+                            "Exception occured publishing MQTT message. Item "
+                            "value: %s", item)
+                        self._errcount += 1
+                        if self._errcount > 10:
+                            # Terminate MQTT if errors accumulate
+                            raise
+            finally:
+                # Mark the whole burst done, even if an error ends the loop
+                for _ in items:
+                    task_done()
+
+        self.tick = tick
+        try:
+            self._flush_batch()
+        except Exception:
+            LOG.exception("Exception occured publishing final MQTT batch.")
+        if self.transport == 'awsiot':
+            # Allow the SDK to finish sending queued messages before disconnect
+            time.sleep(0.25)
         self.client.disconnect()
+        if self.transport == 'paho':
+            self.client.loop_stop()
 
 
 __plugin__ = MQTTClient